@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import json
+import numpy as np
+import ParsedHMM
+import HitTable
+
+# Description of each exported array, saved in the manifest. Master and template columns are 1-based
+ARRAY_DESCRIPTIONS = {
+    'master_heights': "Total conservation height (bits) of each master column",
+    'master_clustal_colours': "Height (bits) of each colour group at each master column, in the order of colours",
+    'master_ss': "PSIPRED secondary structure of each master column, as ASCII codes: 72 (H) helix, 69 (E) "
+                 "strand and 67 (C) coil",
+    'master_ss_probs': "PSIPRED confidence of each master column, from 0 (lowest) to 9 (highest)",
+    'hit_numbers': "Number of each hit in the hits search",
+    'hit_names': "Name of the template of each hit",
+    'hit_probs': "HHSearch probability (%) of each hit",
+    'hit_e_values': "E-value of each hit",
+    'hit_starts': "First master column covered by each hit",
+    'hit_ends': "Last master column covered by each hit",
+    'hit_template_starts': "First template column aligned in each hit",
+    'hit_template_ends': "Last template column aligned in each hit",
+    'hit_template_lengths': "Total length of the template of each hit",
+    'domain_starts': "First master column of each domain, in the order of domains, or -1 if none of its PFAM hits "
+                     "are in the pfam search",
+    'domain_ends': "Last master column of each domain, in the order of domains, or -1 if none of its PFAM hits "
+                   "are in the pfam search",
+    'domain_resolved': "Whether any of each domain's PFAM hits are in the pfam search, in the order of domains",
+}
+
+class FigureModel:
+    """
+
+    FigureModel holds the numbers behind a figure - the master's conservation and secondary
+    structure, the ranked hits and the resolved domain spans - and exports them for downstream
+    tools, so that they do not need to re-parse the PDF or rerun the whole pipeline.
+
+    """
+
+    config = None
+    parsed_hmm_master = None
+    hit_table = None
+    hit_order = None
+    domain_spans = None
+    domain_resolved = None
+
+    def __init__(self, config, parsed_hmm_master=None):
+        """
+        Initialising a FigureModel computes the figure data from the configuration.
+
+        Parameters
+        ----------
+        config: dict
+            the configuration dictionary - see OutputFigure
+        parsed_hmm_master: ParsedHMM
+            the already parsed master HMM. If None, the master is parsed from config.master
+        """
+
+        if parsed_hmm_master is None:
+            parsed_hmm_master = ParsedHMM.ParsedHMM(config)
+        self.config = config
+        self.parsed_hmm_master = parsed_hmm_master
+
+        # Rank the hits by E-value, skipping the master itself, in the same order as add_hits
+        self.hit_table = HitTable.HitTable(config['searches']['hits'])
+        self.hit_order = self.hit_table.get_ranked_indices()
+
+        # Resolve the domains to their spans on the master, with -1 for domains whose hits are not in the
+        # table (rather than the (100000, 0) that get_span returns for drawing)
+        pfam_table = HitTable.HitTable(config['searches']['pfam'])
+        self.domain_spans = np.array([pfam_table.get_span(domain['pfam_hit_number']) for domain in config['domains']],
+                                     dtype=np.int64).reshape(-1, 2)
+        self.domain_resolved = np.array([np.any(np.isin(pfam_table.numbers, domain['pfam_hit_number']))
+                                         for domain in config['domains']], dtype=bool)
+        self.domain_spans[~self.domain_resolved] = -1
+
+    def save(self, file_name):
+        """
+        Saves the figure data as <file_name>.npz, a compressed NumPy archive with one array per
+        column of data, and <file_name>.json, a manifest describing each array alongside the
+        non-numeric details of the figure. Both are written in one pass over the data.
+
+        Parameters
+        ----------
+        file_name: str
+            the path to save to, without an extension
+        """
+        hmm = self.parsed_hmm_master
+        order = self.hit_order
+        arrays = {
+            # Per-column data for the master
+            'master_heights': np.asarray(hmm.height_array, dtype=np.float64),
+            'master_clustal_colours': np.asarray(hmm.clustal_colours, dtype=np.float64).reshape(-1, len(self.config['colours'])),
+            'master_ss': hmm.ss,
+            'master_ss_probs': hmm.ss_probs,
+            # Hits, ranked from lowest to highest E-value
+            'hit_numbers': self.hit_table.numbers[order],
+            'hit_names': np.array([self.hit_table.names[hit_idx] for hit_idx in order], dtype=str),
+            'hit_probs': self.hit_table.probs[order],
+            'hit_e_values': self.hit_table.e_values[order],
+            'hit_starts': self.hit_table.starts[order],
+            'hit_ends': self.hit_table.ends[order],
+            'hit_template_starts': self.hit_table.hit_starts[order],
+            'hit_template_ends': self.hit_table.hit_ends[order],
+            'hit_template_lengths': self.hit_table.hit_lengths[order],
+            # Domain spans, in the order of config.domains
+            'domain_starts': self.domain_spans[:, 0],
+            'domain_ends': self.domain_spans[:, 1],
+            'domain_resolved': self.domain_resolved,
+        }
+        np.savez_compressed(file_name + '.npz', **arrays)
+
+        manifest = {
+            'master': {
+                'name': hmm.name,
+                'length': hmm.length,
+                'hmm_file': self.config['master']['hmm_file'],
+            },
+            'searches': self.config['searches'],
+            'colours': [colour['name'] for colour in self.config['colours']],
+            'domains': [{'name': domain['name'], 'colour': domain['colour']} for domain in self.config['domains']],
+            'max_hits': self.config['output']['max_hits'],
+            'arrays': {name: {'dtype': str(array.dtype), 'shape': list(array.shape),
+                              'description': ARRAY_DESCRIPTIONS[name]} for name, array in arrays.items()},
+        }
+        manifest['arrays']['master_ss']['encoding'] = 'ascii'
+        with open(file_name + '.json', 'w') as json_file:
+            json.dump(manifest, json_file, indent=2)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import re
+import numpy as np
+
+# Prob, E-value, P-value, Score, SS, Cols, Query HMM range, Template HMM range and (template length)
+HIT_LINE = re.compile(r'(\S+)\s+(\S+)\s+\S+\s+\S+\s+\S+\s+\d+\s+(\d+)-(\d+)\s+(\d+)-(\d+)\s*\(?(\d+)\)?\s*$')
+
+class HitTable:
+    """
+    HitTable represents the summary table at the top of a HHSearch results file. Every hit in the
+    table is stored column-wise in NumPy arrays so that the whole table (which can run to many
+    thousands of hits) can be processed without looping over the hits in Python.
+    """
+
+    def __init__(self, file_name):
+        """
+        Initialising a HitTable reads the summary table of a HHSearch results file.
+
+        Parameters
+        ----------
+        file_name: str
+            the path of the HHSearch results file (e.g. config['searches']['hits'])
+        """
+
+        numbers = []
+        names = []
+        probs = []
+        e_values = []
+        query_ranges = []
+        template_ranges = []
+        template_lengths = []
+
+        with open(file_name, 'r') as file:
+            in_table = False
+            for line in file:
+                if line.startswith(" No Hit"):
+                    in_table = True
+                    continue
+                if in_table:
+                    # The table ends at the first blank line
+                    if not line.strip():
+                        break
+                    # Hit names can contain spaces (e.g. PFAM descriptions), so match the numeric columns
+                    # from the end. Long templates run their range into the length, e.g. 1081-1197(1378)
+                    match = HIT_LINE.search(line)
+                    numbers.append(int(line.split()[0]))
+                    names.append(line.split()[1])
+                    probs.append(float(match.group(1)))
+                    e_values.append(float(match.group(2)))
+                    query_ranges.append(match.group(3, 4))
+                    template_ranges.append(match.group(5, 6))
+                    template_lengths.append(match.group(7))
+
+        self.numbers = np.array(numbers, dtype=np.int64) # Hit number as given in the first column of the table
+        self.names = names # Name of the template of each hit
+        self.probs = np.array(probs, dtype=np.float64) # HHSearch probability of each hit
+        self.e_values = np.array(e_values, dtype=np.float64) # E-value of each hit
+        query_ranges = np.array(query_ranges, dtype=np.int64).reshape(-1, 2)
+        self.starts = query_ranges[:, 0] # First master column (1-based, inclusive) covered by each hit
+        self.ends = query_ranges[:, 1] # Last master column (1-based, inclusive) covered by each hit
+        template_ranges = np.array(template_ranges, dtype=np.int64).reshape(-1, 2)
+        self.hit_starts = template_ranges[:, 0] # First template column aligned in each hit
+        self.hit_ends = template_ranges[:, 1] # Last template column aligned in each hit
+        self.hit_lengths = np.array(template_lengths, dtype=np.int64) # Total length of each template
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def get_span(self, hit_numbers):
+        """
+        Returns the first and last master columns covered by any of the given hits, or (100000, 0) if
+        none of them are in the table.
+
+        Parameters
+        ----------
+        hit_numbers: int or list
+            the hit number(s) to include, as in the pfam_hit_number field of a configured domain
+        """
+        hits = np.isin(self.numbers, hit_numbers)
+        if not np.any(hits):
+            return 100000, 0
+        return int(np.min(self.starts[hits])), int(np.max(self.ends[hits]))
+
+    def get_mask(self, skip_first=True):
+        """
+        Returns a boolean mask of the hits to include in whole-table calculations.
+
+        Parameters
+        ----------
+        skip_first: bool
+            whether to leave out hit number 1, which for a search against your own database is the
+            master itself (add_hits also starts from hit 2)
+        """
+        if skip_first:
+            return self.numbers != 1
+        return np.ones(len(self), dtype=bool)
+
+    def get_ranked_indices(self, skip_first=True):
+        """
+        Returns the indices of the hits included by get_mask, ordered from lowest to highest E-value.
+        Hits with equal E-values keep their order in the table.
+
+        Parameters
+        ----------
+        skip_first: bool
+            see get_mask
+        """
+        mask = self.get_mask(skip_first)
+        return np.nonzero(mask)[0][np.argsort(self.e_values[mask], kind='stable')]
+
+    def get_coverage(self, length, skip_first=True):
+        """
+        Returns the number of hits covering each column of the master, computed with a difference
+        array: +1 where each hit starts, -1 after it ends, followed by a cumulative sum.
+
+        Parameters
+        ----------
+        length: int
+            the number of columns in the master HMM
+        skip_first: bool
+            see get_mask
+        """
+        mask = self.get_mask(skip_first)
+        starts = np.clip(self.starts[mask] - 1, 0, length)
+        ends = np.clip(self.ends[mask], 0, length)
+        difference = np.bincount(starts, minlength=length + 1) - np.bincount(ends, minlength=length + 1)
+        return np.cumsum(difference[:length])
+
+    def get_binned_coverage(self, length, bins, skip_first=True):
+        """
+        Returns an array of shape (len(bins) + 1, length) holding the number of hits covering each
+        master column, split by E-value bin. Row k counts hits with bins[k - 1] <= E < bins[k], so
+        row 0 holds the best hits. The difference arrays for every bin are accumulated in one pass.
+
+        Parameters
+        ----------
+        length: int
+            the number of columns in the master HMM
+        bins: list
+            increasing E-value bin edges, e.g. [0.00001, 0.001, 0.05, 1, 10]
+        skip_first: bool
+            see get_mask
+        """
+        mask = self.get_mask(skip_first)
+        bin_idx = np.searchsorted(np.asarray(bins, dtype=np.float64), self.e_values[mask], side='right')
+        starts = np.clip(self.starts[mask] - 1, 0, length)
+        ends = np.clip(self.ends[mask], 0, length)
+        difference = np.zeros((len(bins) + 1, length + 1), dtype=np.int64)
+        np.add.at(difference, (bin_idx, starts), 1)
+        np.add.at(difference, (bin_idx, ends), -1)
+        return np.cumsum(difference[:, :length], axis=1)
+
+    def get_best_e_values(self, length, skip_first=True):
+        """
+        Returns the lowest E-value of any hit covering each master column (np.inf where there is no
+        hit). Each hit interval is split into the O(log length) nodes of a bottom-up segment tree,
+        with all hits processed together at each level, and each column then takes the minimum over
+        its ancestors in the tree.
+
+        Parameters
+        ----------
+        length: int
+            the number of columns in the master HMM
+        skip_first: bool
+            see get_mask
+        """
+        mask = self.get_mask(skip_first)
+        e_values = self.e_values[mask]
+        size = 1
+        while size < length:
+            size *= 2
+        tree = np.full(2 * size, np.inf)
+        # Half-open leaf ranges [left, right) for every hit
+        left = np.clip(self.starts[mask] - 1, 0, length) + size
+        right = np.clip(self.ends[mask], 0, length) + size
+        while np.any(left < right):
+            active = left < right
+            take_left = active & (left % 2 == 1)
+            np.minimum.at(tree, left[take_left], e_values[take_left])
+            left = left + take_left
+            take_right = active & (right % 2 == 1)
+            right = right - take_right
+            np.minimum.at(tree, right[take_right], e_values[take_right])
+            left = left // 2
+            right = right // 2
+        # Push the minima down to the leaves
+        best = tree[size:size + length].copy()
+        nodes = np.arange(size, size + length) // 2
+        while np.any(nodes > 0):
+            np.minimum(best, tree[nodes], out=best)
+            nodes = nodes // 2
+        return best
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import cairo
+import concurrent.futures
+import ParsedHMM
+from OutputFigure import OutputFigure
+
+class MultiOutputFigure:
+    """
+
+    MultiOutputFigure generates one document containing a panel for each of several master HMMs
+    (e.g. the members of a complex). Each panel is drawn by OutputFigure, and the panels share one
+    cache of parsed hit HMMs so that hits common to several masters are only loaded once.
+
+    """
+
+    cr = None
+    config = None
+    panel_configs = None
+    parsed_hmm_masters = None
+    hmm_cache = None
+
+    def __init__(self, config, add_hits):
+        """
+        Initialising a MultiOutputFigure generates and saves the figure.
+
+        Parameters
+        ----------
+        config: dict
+            the configuration dictionary. This has the same sections as for OutputFigure, except that
+            master, searches and domains are replaced by a masters list, where each item holds the
+            master, searches and domains sections for one panel
+        add_hits: bool
+            see OutputFigure
+        """
+
+        self.config = config
+        self.hmm_cache = {}
+        if config['output']['file_name'].endswith('.png') and config['output'].get('panel_layout', 'stacked') == 'pages':
+            print("A PNG can only hold one page - use the stacked panel_layout, or save to a PDF.")
+            exit(1)
+
+        # Build an OutputFigure configuration for each panel
+        self.panel_configs = []
+        for panel_idx in range(len(config['masters'])):
+            panel_config = dict(config)
+            del panel_config['masters']
+            panel_config.update(config['masters'][panel_idx])
+            panel_config['page'] = dict(config['page'])
+            if config['output'].get('panel_layout', 'stacked') == 'stacked':
+                # Move each panel down the page by one page height
+                panel_config['page']['padding_top'] += panel_idx * config['page']['height']
+            self.panel_configs.append(panel_config)
+
+        # Parse the masters in parallel
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            self.parsed_hmm_masters = list(executor.map(ParsedHMM.ParsedHMM, self.panel_configs))
+
+        # Set up the page, wide enough for the longest master
+        width = max([hmm.length for hmm in self.parsed_hmm_masters]) + config['page']['horizontal_padding']
+        if config['output'].get('panel_layout', 'stacked') == 'stacked':
+            height = len(self.panel_configs) * config['page']['height']
+        else:
+            height = config['page']['height']
+        if config['output']['file_name'].endswith('.png'):
+            # Draw a bitmap on a white background
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            self.cr = cairo.Context(surface)
+            self.cr.set_source_rgb(1, 1, 1)
+            self.cr.paint()
+        else:
+            surface = cairo.PDFSurface(config['output']['file_name'], width, height)
+            self.cr = cairo.Context(surface)
+
+        # Draw each panel
+        for panel_idx in range(len(self.panel_configs)):
+            OutputFigure(self.panel_configs[panel_idx], add_hits, self.parsed_hmm_masters[panel_idx], self.cr,
+                         self.hmm_cache)
+            if config['output'].get('panel_layout', 'stacked') == 'pages':
+                # One page per master
+                self.cr.show_page()
+
+        # Save the file
+        if config['output']['file_name'].endswith('.png'):
+            surface.write_to_png(config['output']['file_name'])
+        elif config['output'].get('panel_layout', 'stacked') == 'stacked':
+            self.cr.show_page()
+        surface.finish()
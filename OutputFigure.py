@@ -6,8 +6,8 @@ import numpy as np
 import sys
 import json
 import ParsedHMM
+import HitTable
 import colorsys
-import collections
 import os.path
 from scipy.stats import rankdata
 
@@ -25,8 +25,9 @@ class OutputFigure:
     padding_top = 0
     config = None
     parsed_hmm_master = None
+    hmm_cache = None
 
-    def __init__(self, config, add_hits):
+    def __init__(self, config, add_hits, parsed_hmm_master=None, cr=None, hmm_cache=None):
         """
         Initialising an OutputFigure is the interface through which a figure is generated and saved.
         This means that unless you are modifying this module, this is the only method which you are
@@ -42,26 +43,52 @@ class OutputFigure:
             this determines whether to just draw the domains and secondary structure for the main protein
             of interest (if add_hits is False), or whether to retrieve up to config.output.max_hits number
             of hits to also include (if add_hits is True)
+        parsed_hmm_master: ParsedHMM
+            the already parsed master HMM. If None, the master is parsed from config.master
+        cr: cairo.Context
+            the context to draw onto. If None, a new PDF is created at config.output.file_name and saved
+            once drawing is finished; otherwise the caller is responsible for saving
+        hmm_cache: dict
+            parsed hit HMMs keyed by file name, shared between figures so that each hit HMM is only
+            parsed once. If None, a new cache is used for this figure
         """
 
         # Load the HMM
-        self.parsed_hmm_master = ParsedHMM.ParsedHMM(config)
+        if parsed_hmm_master is None:
+            parsed_hmm_master = ParsedHMM.ParsedHMM(config)
+        self.parsed_hmm_master = parsed_hmm_master
         # Store the config and HMM
         self.config = config
+        self.hmm_cache = hmm_cache if hmm_cache is not None else {}
         # Set up the page
         self.padding_left = config['page']['padding_left']
         self.padding_top = config['page']['padding_top']
-        surface = cairo.PDFSurface(config['output']['file_name'],
-                                   self.parsed_hmm_master.length + config['page']['horizontal_padding'],
-                                   config['page']['height'])
-        self.cr = cairo.Context(surface)
+        if cr is None and config['output']['file_name'].endswith('.png'):
+            # Draw a bitmap on a white background
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                         self.parsed_hmm_master.length + config['page']['horizontal_padding'],
+                                         config['page']['height'])
+            self.cr = cairo.Context(surface)
+            self.cr.set_source_rgb(1, 1, 1)
+            self.cr.paint()
+        elif cr is None:
+            surface = cairo.PDFSurface(config['output']['file_name'],
+                                       self.parsed_hmm_master.length + config['page']['horizontal_padding'],
+                                       config['page']['height'])
+            self.cr = cairo.Context(surface)
+        else:
+            self.cr = cr
         # Draw the master sequence
         self.draw_master_sequence()
+        if 'coverage_track' in config['output']:
+            # Summarise the whole hit table above the master
+            self.draw_coverage_track()
         if add_hits:
             # Add the extra hits
             self.add_hits()
         # Save the file
-        self.save_file()
+        if cr is None:
+            self.save_file()
 
     def plot_clustal(self, scale, max_bitscore, position, offset_horizontal, draw_full_rectangle, hmm):
         # Draw axes
@@ -70,12 +97,12 @@ class OutputFigure:
         self.cr.move_to(offset_horizontal - 0.5, position - 1)
         self.cr.line_to(offset_horizontal - 0.5, position + scale * max_bitscore)
         self.cr.move_to(offset_horizontal - 1, position + + scale * max_bitscore)
-        self.cr.line_to(offset_horizontal + len(hmm.probs) + 0.5, position + scale * max_bitscore)
+        self.cr.line_to(offset_horizontal + len(hmm.prob_scores) + 0.5, position + scale * max_bitscore)
         if draw_full_rectangle:
             self.cr.move_to(offset_horizontal - 1, position - 1)
-            self.cr.line_to(offset_horizontal + len(hmm.probs) + 0.5, position - 1)
-            self.cr.move_to(offset_horizontal + len(hmm.probs) + 0.5, position - 1)
-            self.cr.line_to(offset_horizontal + len(hmm.probs) + 0.5, position + scale * max_bitscore + 0.5)
+            self.cr.line_to(offset_horizontal + len(hmm.prob_scores) + 0.5, position - 1)
+            self.cr.move_to(offset_horizontal + len(hmm.prob_scores) + 0.5, position - 1)
+            self.cr.line_to(offset_horizontal + len(hmm.prob_scores) + 0.5, position + scale * max_bitscore + 0.5)
         self.cr.set_font_size(4 * np.log(scale * max_bitscore / 5))
         self.cr.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
         for i in range(6):
@@ -186,53 +213,99 @@ class OutputFigure:
             self.cr.stroke()
 
             # Add domains from pfam folder
-            with open(self.config['searches']['pfam'], 'r') as file:
-                lines = file.readlines()
-                # Look for start and end position of each hit
-                for hit_group in range(len(self.config['domains'])):
-                    # Store start and end position
-                    start = 100000
-                    end = 0
-                    # Move on to
-                    if isinstance(self.config['domains'][hit_group]['pfam_hit_number'], list):
-                        for hit in range(len(self.config['domains'][hit_group]['pfam_hit_number'])):
-                            for line in lines:
-                                # Look for hits of our numbers
-                                if line.strip().startswith(
-                                        str(self.config['domains'][hit_group]['pfam_hit_number'][hit]) + " "):
-                                    columns = line.split()
-                                    start = np.min([start, int(columns[len(columns) - 3].split('-')[0])])
-                                    end = np.max([end, int(columns[len(columns) - 3].split('-')[1])])
-                    else:
-                        # Look for hits of our numbers
-                        for line in lines:
-                            if line.strip().startswith(str(self.config['domains'][hit_group]['pfam_hit_number']) + " "):
-                                columns = line.split()
-                                start = int(columns[len(columns) - 3].split('-')[0])
-                                end = int(columns[len(columns) - 3].split('-')[1])
-
-                    # Now draw that hit group on
-                    if start > self.config['output']['split_at'] and vertical_pos_index is 0 or start < \
-                            self.config['output'][
-                                'split_at'] and vertical_pos_index is 1:
-                        self.cr.set_source_rgba(0.5, 0.5, 0.5, 0.5)
-                    else:
-                        self.cr.set_source_rgba(self.config['domains'][hit_group]['colour'][0],
-                                                self.config['domains'][hit_group]['colour'][1],
-                                                self.config['domains'][hit_group]['colour'][2],
-                                                self.config['domains'][hit_group]['colour'][3])
-                    self.cr.set_line_width(1)
-                    self.cr.rectangle(self.padding_left + start, vertical_pos + 180.5, end - start, 39)
-                    self.cr.fill()
-                    self.cr.stroke()
-                    # Label it
-                    self.cr.set_font_size(20)
-                    self.cr.set_source_rgb(0, 0, 0)
-                    name = self.config['domains'][hit_group]['name']
-                    (x, y, width, height, dx, dy) = self.cr.text_extents(name)
-                    self.cr.move_to(self.padding_left + start + ((end - start) - width) / 2,
-                                    vertical_pos + 200 + height / 2)
-                    self.cr.show_text(name)
+            pfam_table = HitTable.HitTable(self.config['searches']['pfam'])
+            # Look for start and end position of each hit
+            for hit_group in range(len(self.config['domains'])):
+                start, end = pfam_table.get_span(self.config['domains'][hit_group]['pfam_hit_number'])
+
+                # Now draw that hit group on
+                if start > self.config['output']['split_at'] and vertical_pos_index is 0 or start < \
+                        self.config['output'][
+                            'split_at'] and vertical_pos_index is 1:
+                    self.cr.set_source_rgba(0.5, 0.5, 0.5, 0.5)
+                else:
+                    self.cr.set_source_rgba(self.config['domains'][hit_group]['colour'][0],
+                                            self.config['domains'][hit_group]['colour'][1],
+                                            self.config['domains'][hit_group]['colour'][2],
+                                            self.config['domains'][hit_group]['colour'][3])
+                self.cr.set_line_width(1)
+                self.cr.rectangle(self.padding_left + start, vertical_pos + 180.5, end - start, 39)
+                self.cr.fill()
+                self.cr.stroke()
+                # Label it
+                self.cr.set_font_size(20)
+                self.cr.set_source_rgb(0, 0, 0)
+                name = self.config['domains'][hit_group]['name']
+                (x, y, width, height, dx, dy) = self.cr.text_extents(name)
+                self.cr.move_to(self.padding_left + start + ((end - start) - width) / 2,
+                                vertical_pos + 200 + height / 2)
+                self.cr.show_text(name)
+
+    def draw_coverage_track(self):
+        # Aggregate every hit in the table, not just the max_hits drawn as rows
+        track_config = self.config['output']['coverage_track']
+        track_height = track_config.get('height', 60)
+        strip_height = 10
+        # Sit above the master's conservation plot, or above the upper master box in split view
+        position = self.padding_top - self.get_coverage_track_space()
+        if self.config['output']['split']:
+            position -= 70
+        length = self.parsed_hmm_master.length
+        hit_table = HitTable.HitTable(self.config['searches']['hits'])
+        coverage = hit_table.get_coverage(length)
+        max_coverage = max(int(np.max(coverage)), 1)
+
+        # Draw axes
+        self.cr.set_source_rgb(0, 0, 0)
+        self.cr.set_line_width(1)
+        self.cr.move_to(self.padding_left - 0.5, position - 1)
+        self.cr.line_to(self.padding_left - 0.5, position + track_height)
+        self.cr.move_to(self.padding_left - 1, position + track_height)
+        self.cr.line_to(self.padding_left + length + 0.5, position + track_height)
+        self.cr.set_font_size(12)
+        self.cr.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        for label, y in [("0", position + track_height), (str(max_coverage), position)]:
+            (x, y_bearing, width, height, dx, dy) = self.cr.text_extents(label)
+            self.cr.move_to(self.padding_left - 10 - width, y + height / 2)
+            self.cr.show_text(label)
+            self.cr.move_to(self.padding_left - 1, y)
+            self.cr.line_to(self.padding_left - 1 - 6, y)
+        self.cr.stroke()
+        (x, y, width, height, dx, dy) = self.cr.text_extents("Hits")
+        self.cr.move_to(self.padding_left - 50 - height / 2, position + (track_height - width) / 2)
+        self.cr.rotate(math.pi / 2)
+        self.cr.show_text("Hits")
+        self.cr.rotate(-math.pi / 2)
+
+        # Number of hits covering each column
+        self.cr.set_source_rgb(0.4, 0.4, 0.4)
+        heights = track_height * coverage / max_coverage
+        for i in np.nonzero(coverage)[0]:
+            self.cr.rectangle(self.padding_left + i, position + track_height - heights[i], 1, heights[i])
+        self.cr.fill()
+
+        # Best E-value at each column, as a strip from green (good) to red (bad)
+        if 'e_value_bins' in track_config:
+            bins = track_config['e_value_bins']
+            binned_coverage = hit_table.get_binned_coverage(length, bins)
+            best_bin = np.argmax(binned_coverage > 0, axis=0)
+            hues = (120 / 360) * (1 - best_bin / len(bins))
+        else:
+            # Log scale spanning E = 1E-10 (green) to E = 1 (red)
+            best_e = hit_table.get_best_e_values(length)
+            with np.errstate(divide='ignore'):
+                hues = (120 / 360) * np.clip(-np.log10(best_e) / 10, 0, 1)
+        for i in np.nonzero(coverage)[0]:
+            col = colorsys.hsv_to_rgb(hues[i], 0.5, 1)
+            self.cr.set_source_rgb(col[0], col[1], col[2])
+            self.cr.rectangle(self.padding_left + i, position + track_height + 2, 1, strip_height)
+            self.cr.fill()
+
+    def get_coverage_track_space(self):
+        # Vertical space taken by the coverage track (bar chart, E-value strip and gap below), or 0 without one
+        if 'coverage_track' not in self.config['output']:
+            return 0
+        return self.config['output']['coverage_track'].get('height', 60) + 10 + 30
 
     def add_hits(self):
         # Calculate a spacing factor
@@ -242,6 +315,8 @@ class OutputFigure:
         else:
             spacing = 120
             top_offset = -2.2
+        # In split view, the hits above the master move up to make room for the coverage track
+        top_offset -= self.get_coverage_track_space() / spacing
 
         e_value_array = []
         with open(self.config['searches']['hits'], 'r') as file:
@@ -267,7 +342,7 @@ class OutputFigure:
                 print("--- Starting new OG ---")
                 #print(e_value_array)
                 #print(rankdata(np.array(e_value_array), 'ordinal'))
-                hit_group_in_file = int(np.where(rankdata(np.array(e_value_array), 'ordinal') == counter - 1)[0] + 2)
+                hit_group_in_file = int(np.where(rankdata(np.array(e_value_array), 'ordinal') == counter - 1)[0][0] + 2)
                 #print(hit_group_in_file)
 
 
@@ -435,25 +510,13 @@ class OutputFigure:
                         # NB we can only use Skylign if their .hmm also has a corresponding a3m file
                         # -> check if the a3m exists
                         a3m_file_name = "hmms/" + name + ".fa.hmm.ss.a3m"
-                        if not os.path.isfile(a3m_file_name):
+                        if self.config['output']['conservation_plot']['type'] == 'skylign' and \
+                                not os.path.isfile(a3m_file_name):
                             print(f"The a3m file { a3m_file_name } corresponding to the HMM for { name } was not found.")
                             exit(1)
                         
-                        # Load the HMM
-                        hmm = ParsedHMM.ParsedHMM(
-                            {
-                                "master": {
-                                    "name": name,
-                                    "hmm_file": "hmms/" + name + ".fa.hmm.ss.hmm",
-                                    "alignment_a3m": a3m_file_name
-                                    },
-                                "colours": self.config['colours'],
-                                "output": {
-                                    "conservation_plot": {
-                                        "type": self.config['output']['conservation_plot']['type']
-                                    }
-                                }
-                            })
+                        # Load the HMM, reusing it if it has already been parsed for another figure
+                        hmm = ParsedHMM.load_hit(name, self.config, self.hmm_cache)
                         # Do some debug printing
                         print(name)
                         print(hmm.length)
@@ -483,12 +546,12 @@ class OutputFigure:
         self.cr.move_to(offset_horizontal - 0.5, position - 1)
         self.cr.line_to(offset_horizontal - 0.5, position + scale * max_bitscore)
         self.cr.move_to(offset_horizontal - 1, position + + scale * max_bitscore)
-        self.cr.line_to(offset_horizontal + len(hmm.probs) + 0.5, position + scale * max_bitscore)
+        self.cr.line_to(offset_horizontal + len(hmm.prob_scores) + 0.5, position + scale * max_bitscore)
         if True:
             self.cr.move_to(offset_horizontal - 1, position - 1)
-            self.cr.line_to(offset_horizontal + len(hmm.probs) + 0.5, position - 1)
-            self.cr.move_to(offset_horizontal + len(hmm.probs) + 0.5, position - 1)
-            self.cr.line_to(offset_horizontal + len(hmm.probs) + 0.5, position + scale * max_bitscore + 0.5)
+            self.cr.line_to(offset_horizontal + len(hmm.prob_scores) + 0.5, position - 1)
+            self.cr.move_to(offset_horizontal + len(hmm.prob_scores) + 0.5, position - 1)
+            self.cr.line_to(offset_horizontal + len(hmm.prob_scores) + 0.5, position + scale * max_bitscore + 0.5)
         self.cr.set_font_size(4 * np.log(scale * max_bitscore / 2))
         self.cr.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
         for i in range(3):
@@ -510,19 +573,30 @@ class OutputFigure:
 
         #print(hmm.ss_probs)
 
+        # Optionally smooth the structure and confidence before plotting
+        ss_window = self.config['output'].get('ss_window', {})
+        window_size = ss_window.get('size', 1)
+        if ss_window.get('mode', 'binned') == 'moving':
+            structures, confidences = hmm.get_moving_ss(window_size)
+        else:
+            # Spread each bin back out over the columns in it
+            structures, confidences = hmm.get_binned_ss(window_size)
+            structures = np.repeat(structures, window_size)[:len(hmm.ss)]
+            confidences = np.repeat(confidences, window_size)[:len(hmm.ss)]
+
         # Plot the clustal plot on top
-        for i in range(len(hmm.probs)):
+        for i in range(len(hmm.prob_scores)):
             height_offset = 0
 
             #helix SS is in red. The sheet SS is in green. The coil SS is in gray
             col = [0, 1, 0]
-            if hmm.ss[i] == "H":
+            if structures[i] == ord("H"):
                 col = [1, 0, 0]
-            elif hmm.ss[i] == "C":
+            elif structures[i] == ord("C"):
                 col = [0.5, 0.5, 0.5]
 
             # Height is the ss_prob
-            height = int(hmm.ss_probs[i]) * scale
+            height = confidences[i] * scale
 
             self.cr.set_source_rgb(col[0], col[1], col[2])
 
@@ -540,20 +614,24 @@ class OutputFigure:
         pos_y = pos_y + height
         bin_size = math.floor(width)
 
+        # Calculate the structure and confidence to show in each bin
+        ss_window = self.config['output'].get('ss_window', {})
+        if ss_window.get('mode', 'binned') == 'moving':
+            # Sample a moving average at the centre of each bin
+            structures, confidences = hmm.get_moving_ss(ss_window.get('size', bin_size))
+            centres = np.minimum(np.arange(0, len(hmm.ss), bin_size) + bin_size // 2, len(hmm.ss) - 1)
+            structures = structures[centres]
+            confidences = confidences[centres]
+        else:
+            bin_size = ss_window.get('size', bin_size)
+            structures, confidences = hmm.get_binned_ss(bin_size)
+
         # Go through in each bin size
-        idx = 0
-        while idx < hmm.length/bin_size:
+        for idx in range(len(structures)):
             bin_mean_sequence_pos = idx*bin_size - bin_size/2
 
-            ss_in_bin = hmm.ss[idx*bin_size:(idx+1)*bin_size]
-            # print(ss_in_bin)
-            mean_structure = list(collections.Counter(ss_in_bin).most_common(1)[0])[0]
-            confidence_in_bin = hmm.ss_probs[idx*bin_size:(idx+1)*bin_size]
-            # print(confidence_in_bin)
-            sum_confidence = 0
-            for c in list(confidence_in_bin):
-                sum_confidence += int(c)
-            bin_confidence = int(np.round(sum_confidence/bin_size))
+            mean_structure = chr(structures[idx])
+            bin_confidence = int(np.round(confidences[idx]))
 
             if pos_x + bin_mean_sequence_pos > right_cutoff:
                 return
@@ -588,8 +666,9 @@ class OutputFigure:
             self.cr.move_to(pos_x + bin_mean_sequence_pos + 2, pos_y+height+4)
             self.cr.show_text(str(bin_confidence))
 
-            idx += 1
-
     def save_file(self):
         self.cr.save()
-        self.cr.show_page()
+        if self.config['output']['file_name'].endswith('.png'):
+            self.cr.get_target().write_to_png(self.config['output']['file_name'])
+        else:
+            self.cr.show_page()
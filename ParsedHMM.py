@@ -4,6 +4,10 @@ import math
 import requests
 import numpy as np
 import json
+import warnings
+
+# Stored in place of '*' (a probability of 0) in the integer-scaled HHM scores
+SCORE_ZERO_PROB = 65535
 
 class ParsedHMM:
     """ 
@@ -24,18 +28,19 @@ class ParsedHMM:
         """
 
         # Define the important parameters as object variables
-        self.hmm_string = '' # The string containing only the data part of the HMM (not any headers)
         self.alphabet = [] # The list of amino acids contained within the MSA alphabet
         self.states = [] # List of states that each column of MSA can be in (insertion, deletion, etc)
-        self.probs = [] # Probability of each item in the alphabet being at each column
-        self.state_probs = [] # Probability of the self.states (insertion, deletion, etc) at each column
-        self.clustal_colours = [] # List (length of MSA) where each item is a list height of the clustal category heights at that position
+        self.prob_scores = [] # HHM scores (-1000 * log2 p, as uint16) of each item in the alphabet at each column - see get_probs
+        self.state_prob_scores = [] # HHM scores (as uint16) of the self.states (insertion, deletion, etc) at each column - see get_state_probs
+        self.compact = 'output' in config and config['output'].get('compact', False) # Store heights and decode scores as float32 rather than float64
+        self.clustal_colours = [] # Array (length of MSA, number of colours) of the clustal category heights at each position
         self.height_array = [] # Total height of each column (in MSA), as given by Shannon entropy
-        self.ss = '' # Secondary structure positions, where len(ss) = len(probs) such that there is one prediction for each column
-        self.ss_probs = '' # Probabilities corresponding to each secondary structure prediction
+        self.ss = '' # Secondary structure positions (uint8 array of ASCII codes once parsed), where len(ss) = len(prob_scores) such that there is one prediction for each column
+        self.ss_probs = '' # Probabilities corresponding to each secondary structure prediction (uint8 array of 0-9 once parsed)
         self.nulls = [] # Null/underlying probabilities, each item corresponding the alphabet item at that position
 
-        # Process HMM
+        # Process HMM, keeping the data part (not any headers) as a string until it is parsed
+        hmm_string = ''
         print(config['master']['hmm_file'])
         with open(config['master']['hmm_file']) as hmm:
             in_hmm_section = False
@@ -54,7 +59,7 @@ class ParsedHMM:
                 if line.startswith("HMM"):
                     in_hmm_section = True
                 if in_hmm_section:
-                    self.hmm_string += line
+                    hmm_string += line
 
                 # Process null
                 if line.startswith("NULL"):
@@ -77,12 +82,12 @@ class ParsedHMM:
                 if "ss_conf PSIPRED confidence values" in line:
                     in_psipred_ss_probs = True
 
-        # Remove linebreaks/whitespace from ss and ss_probs
-        self.ss = ''.join(self.ss.split())
-        self.ss_probs = ''.join(self.ss_probs.split())
+        # Remove linebreaks/whitespace from ss and ss_probs, and store them as arrays for windowing
+        self.ss = np.frombuffer(''.join(self.ss.split()).encode('ascii'), dtype=np.uint8).copy()
+        self.ss_probs = np.frombuffer(''.join(self.ss_probs.split()).encode('ascii'), dtype=np.uint8) - ord('0')
 
         # Now process the HMM string we have
-        hmm_lines = self.hmm_string.split("\n")
+        hmm_lines = hmm_string.split("\n")
         for idx, line in enumerate(hmm_lines):
             # Extract the fields within the HMM file
             if line.startswith("HMM"):
@@ -92,53 +97,46 @@ class ParsedHMM:
                 for hmm_line in range(len(hmm_lines[idx + 1].split())):
                     self.states.append(hmm_lines[idx + 1].split()[hmm_line])
 
-        # Now move on to the match states themselves
+        # Now move on to the match states themselves, keeping the integer scores rather than probabilities
         for l in range(self.length):
             alphabet_line = hmm_lines[l * 3 + 3].split()
             stats_line = hmm_lines[l * 3 + 4].split()
-            current_alphabet_probs = []
+            current_alphabet_scores = []
             for a in range(len(alphabet_line)):
                 if a > 1 and a < len(alphabet_line) - 1:
-                    if alphabet_line[a] is '*':
-                        f = 0
+                    if alphabet_line[a] == '*':
+                        f = SCORE_ZERO_PROB
                     else:
-                        f = 2 ** (int(alphabet_line[a]) / -1000)
-                    current_alphabet_probs.append(f)
-            self.probs.append(current_alphabet_probs)
+                        f = int(alphabet_line[a])
+                    current_alphabet_scores.append(f)
+            self.prob_scores.append(current_alphabet_scores)
             current_states = []
             for s in range(len(stats_line)):
-                if stats_line[s] is '*':
-                    f = 0
+                if stats_line[s] == '*':
+                    f = SCORE_ZERO_PROB
                 else:
-                    f = 2 ** (int(stats_line[s]) / -1000)
+                    f = int(stats_line[s])
                 current_states.append(f)
-            self.state_probs.append(current_states)
-
+            self.state_prob_scores.append(current_states)
+        self.prob_scores = np.array(self.prob_scores, dtype=np.uint16).reshape(self.length, -1)
+        self.state_prob_scores = np.array(self.state_prob_scores, dtype=np.uint16).reshape(self.length, -1)
 
+        height_dtype = np.float32 if self.compact else np.float64
         if 'output' not in config or config['output']['conservation_plot']['type'] == 'traditional':
-            # Go through each position and calculate the height
-            for height_idx in range(len(self.probs)):
-                entropy = self.get_shannon_entropy(height_idx)
-
-                height = entropy
-                self.height_array.append(height)
-            for aa_idx in range(len(self.probs)):
-                # Get the total height for that position in the MSA
-                height = self.height_array[aa_idx]
-                # Start with a zero for the height of each colour at that position
-                heights = [0 for colour in range(len(config['colours']))]
-                for j in range(len(self.probs[aa_idx])):
-                    aa_prob = self.probs[aa_idx][j]
-                    aa_name = self.alphabet[j]
-                    for k in range(len(config['colours'])):
-                        if aa_name in config['colours'][k]['aa']:
-                            if aa_prob > self.nulls[j]:
-                                heights[k] += aa_prob * height
-                self.clustal_colours.append(heights)
+            # Decode the scores once for every column
+            probs = self.get_probs()
+            # The height of each position is given by Shannon entropy
+            heights = self.get_shannon_entropies(probs)
+            self.height_array = heights.astype(height_dtype)
+            # Split the height at each position between the colour groups of the residues above null
+            above_null = np.where(probs > np.array(self.nulls, dtype=probs.dtype), probs, 0)
+            in_colour = np.array([[aa_name in colour['aa'] for colour in config['colours']]
+                                  for aa_name in self.alphabet], dtype=probs.dtype)
+            self.clustal_colours = ((above_null * heights[:, np.newaxis]) @ in_colour).astype(height_dtype)
         elif config['output']['conservation_plot']['type'] == 'skylign':
             # Get the HMM file and send it to skylign via post
             print("Making request")
-            r = requests.post('http://skylign.org/',
+            r = requests.post(config['output']['conservation_plot'].get('url', 'http://skylign.org/'),
                               files = {
                                   'file': ('hmm.a3m', open(config['master']['alignment_a3m'], 'rb')),
                                   'processing': (None, 'hmm'),
@@ -159,7 +157,7 @@ class ParsedHMM:
                     height += float(aa.split(":")[1])
                 self.height_array.append(height)
                 # Now get the heights for each AA group
-                heights = [0, 0, 0, 0, 0, 0, 0, 0]
+                heights = [0] * len(config['colours'])
                 for aa in position:
                     aa_prob = float(aa.split(":")[1])
                     aa_name = aa.split(":")[0]
@@ -167,8 +165,58 @@ class ParsedHMM:
                         if aa_name in config['colours'][k]['aa']:
                             heights[k] += aa_prob
                 self.clustal_colours.append(heights)
+        # A conservation_plot type of 'none' leaves height_array and clustal_colours empty, for HMMs
+        # that are only needed for their probabilities
+        self.height_array = np.array(self.height_array, dtype=height_dtype)
+        self.clustal_colours = np.array(self.clustal_colours, dtype=height_dtype).reshape(-1, len(config['colours']))
         return
 
+    @property
+    def probs(self):
+        """
+        Deprecated - use get_probs, which makes clear that every column is decoded on each access.
+        """
+        warnings.warn("ParsedHMM.probs is deprecated, use get_probs()", DeprecationWarning, stacklevel=2)
+        return self.get_probs()
+
+    @property
+    def state_probs(self):
+        """
+        Deprecated - use get_state_probs.
+        """
+        warnings.warn("ParsedHMM.state_probs is deprecated, use get_state_probs()", DeprecationWarning, stacklevel=2)
+        return self.get_state_probs()
+
+    def get_probs(self):
+        """
+        Returns the probability of each item in the alphabet being at each column, as a (length,
+        alphabet) array. This decodes every column of prob_scores, so should be called once and the
+        result reused, rather than called per column.
+        """
+        return self.decode_scores(self.prob_scores)
+
+    def get_state_probs(self):
+        """
+        Returns the probability of the self.states (insertion, deletion, etc) at each column, as a
+        (length, states) array. As for get_probs, this decodes every column on each call.
+        """
+        return self.decode_scores(self.state_prob_scores)
+
+    def decode_scores(self, scores):
+        """
+        Returns the probabilities 2 ** (-score / 1000) for an array of integer-scaled HHM scores, as
+        float32 for compact HMMs and float64 otherwise.
+
+        Parameters
+        ----------
+        scores: numpy.ndarray
+            uint16 HHM scores, with SCORE_ZERO_PROB in place of '*'
+        """
+        dtype = np.float32 if self.compact else np.float64
+        probs = np.exp2(scores.astype(dtype) / dtype(-1000))
+        probs[scores == SCORE_ZERO_PROB] = 0
+        return probs
+
     def getKullbackLeiblerDistance(self, position):
         raise NotImplementedError
 
@@ -181,13 +229,110 @@ class ParsedHMM:
         height_idx: int
             the column of the MSA for which to calculate the Shanon entropy
         """
-        position = self.probs[height_idx]
-        shannon_entropy = 0
-        for i in range(len(position)):
-            if position[i] > 0:
-                if position[i] > self.nulls[i]:
-                    shannon_entropy += position[i] * math.log2(position[i] / self.nulls[i])
-        return shannon_entropy
+        return float(self.get_shannon_entropies(self.decode_scores(self.prob_scores[height_idx])))
+
+    def get_shannon_entropies(self, probs):
+        """
+        Returns the Shannon entropy of each column in an array of probabilities, counting only the
+        items of the alphabet above their null probability.
+
+        Parameters
+        ----------
+        probs: numpy.ndarray
+            the probabilities of each item in the alphabet, for one column or as a (columns, alphabet)
+            array (e.g. from get_probs)
+        """
+        nulls = np.array(self.nulls, dtype=probs.dtype)
+        above_null = np.where(probs > nulls, probs, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            entropy_terms = above_null * np.log2(above_null / nulls)
+        return np.sum(np.where(above_null > 0, entropy_terms, 0), axis=-1)
+
+    def get_binned_ss(self, bin_size):
+        """
+        Returns the majority secondary structure (as ASCII codes) and the mean confidence in
+        consecutive bins of bin_size columns. The final bin may be shorter than bin_size.
+
+        Parameters
+        ----------
+        bin_size: int
+            the number of columns in each bin
+        """
+        num_bins = -(-len(self.ss) // bin_size)
+        padding = num_bins * bin_size - len(self.ss)
+        # Pad with 0, which is never a structure code, so padding doesn't count towards any structure
+        ss_bins = np.pad(self.ss, (0, padding)).reshape(num_bins, bin_size)
+        probs_bins = np.pad(self.ss_probs.astype(np.float64), (0, padding)).reshape(num_bins, bin_size)
+        structures = np.unique(self.ss)
+        in_bin = ss_bins[:, :, np.newaxis] == structures
+        counts = in_bin.sum(axis=1)
+        # Ties go to the structure seen first in the bin, as with collections.Counter.most_common
+        first_seen = np.where(in_bin, np.arange(bin_size)[:, np.newaxis], bin_size).min(axis=1)
+        majority = np.argmax(counts * (bin_size + 1) - first_seen, axis=1)
+        bin_lengths = np.minimum(bin_size, len(self.ss) - np.arange(num_bins) * bin_size)
+        return structures[majority], probs_bins.sum(axis=1) / bin_lengths
+
+    def get_moving_ss(self, window_size):
+        """
+        Returns the majority secondary structure (as ASCII codes) and the mean confidence in a
+        window of window_size columns centred on each column. Windows are truncated at the ends of
+        the HMM, and averages are taken over the columns actually in the window.
+
+        Parameters
+        ----------
+        window_size: int
+            the number of columns in each window
+        """
+        structures = np.unique(self.ss)
+        one_hot = (self.ss[:, np.newaxis] == structures).astype(np.float64)
+        values = np.column_stack([one_hot, self.ss_probs, np.ones(len(self.ss))])
+        # Window sums as differences of a cumulative sum
+        cumulative = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)])
+        lower = np.arange(len(self.ss)) - (window_size - 1) // 2
+        upper = np.clip(lower + window_size, 0, len(self.ss))
+        lower = np.clip(lower, 0, len(self.ss))
+        sums = cumulative[upper] - cumulative[lower]
+        counts = sums[:, -1]
+        # Ties go to the structure seen first in the window: the next column of each structure at or
+        # after every column, found with a reversed running minimum
+        positions = np.where(one_hot > 0, np.arange(len(self.ss))[:, np.newaxis], len(self.ss))
+        next_seen = np.vstack([np.minimum.accumulate(positions[::-1], axis=0)[::-1],
+                               np.full((1, len(structures)), len(self.ss))])
+        first_seen = next_seen[lower] - lower[:, np.newaxis]
+        majority = np.argmax(sums[:, :len(structures)] * (window_size + 1) - first_seen, axis=1)
+        return structures[majority], sums[:, -2] / counts
 
     def get_small_sample_correction(self):
         return 1 / math.log(2) * (20 - 1) / (2 * self.num_seqs)
+
+
+def load_hit(name, config, hmm_cache):
+    """
+    Returns the ParsedHMM for a hit, parsing hmms/<name>.fa.hmm.ss.hmm only if it is not already in
+    hmm_cache.
+
+    Parameters
+    ----------
+    name: str
+        the name of the hit, as given in the HHSearch results
+    config: dict
+        the figure configuration, from which the colours and conservation plot settings are used
+    hmm_cache: dict
+        parsed hit HMMs keyed by file name, which is updated with the hit if it is parsed
+    """
+    hmm_file_name = "hmms/" + name + ".fa.hmm.ss.hmm"
+    if hmm_file_name not in hmm_cache:
+        hmm_cache[hmm_file_name] = ParsedHMM(
+            {
+                "master": {
+                    "name": name,
+                    "hmm_file": hmm_file_name,
+                    "alignment_a3m": "hmms/" + name + ".fa.hmm.ss.a3m"
+                    },
+                "colours": config['colours'],
+                "output": {
+                    "conservation_plot": config['output']['conservation_plot'],
+                    "compact": config['output'].get('compact', False)
+                }
+            })
+    return hmm_cache[hmm_file_name]
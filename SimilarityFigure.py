@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import math
+import os.path
+import cairo
+import numpy as np
+import ParsedHMM
+import HitTable
+
+class SimilarityFigure:
+    """
+
+    SimilarityFigure generates a compact heatmap of the pairwise profile-profile similarity between
+    the master HMM and its top hits, as a complement to the stacked hit rows drawn by OutputFigure.
+
+    """
+
+    cr = None
+    config = None
+    hmms = None
+    matrix = None
+
+    def __init__(self, config, parsed_hmm_master, hmm_cache=None):
+        """
+        Initialising a SimilarityFigure loads the top hits, calculates the similarity matrix and saves
+        the heatmap to config.output.similarity_heatmap.file_name.
+
+        Parameters
+        ----------
+        config: dict
+            the configuration dictionary - see OutputFigure. The output section must contain a
+            similarity_heatmap section
+        parsed_hmm_master: ParsedHMM
+            the parsed master HMM, which is shown as the first row and column of the heatmap
+        hmm_cache: dict
+            parsed hit HMMs keyed by file name, as for OutputFigure
+        """
+
+        self.config = config
+        heatmap_config = config['output']['similarity_heatmap']
+        if hmm_cache is None:
+            hmm_cache = {}
+
+        # Take the top hits by E-value, skipping the master itself and repeat hits to the same HMM
+        hit_table = HitTable.HitTable(config['searches']['hits'])
+        names = []
+        for hit_idx in hit_table.get_ranked_indices():
+            if len(names) == heatmap_config.get('num_hits', 20):
+                break
+            if hit_table.names[hit_idx] not in names:
+                names.append(hit_table.names[hit_idx])
+        # Leave out the hits that have no HMM file
+        for name in names:
+            if not os.path.isfile("hmms/" + name + ".fa.hmm.ss.hmm"):
+                print("Warning: leaving " + name + " out of the similarity heatmap as hmms/" + name +
+                      ".fa.hmm.ss.hmm does not exist")
+        names = [name for name in names if os.path.isfile("hmms/" + name + ".fa.hmm.ss.hmm")]
+
+        # Only the probabilities are needed, so hits not already parsed for the figure are parsed without
+        # a conservation plot (e.g. without calling Skylign), and kept out of the shared cache
+        profile_config = dict(config)
+        profile_config['output'] = dict(config['output'], conservation_plot={'type': 'none'})
+        profile_cache = dict(hmm_cache)
+        self.hmms = [parsed_hmm_master] + [ParsedHMM.load_hit(name, profile_config, profile_cache) for name in names]
+        self.calculate_similarity(heatmap_config.get('tile_size', 32))
+        self.draw_heatmap(heatmap_config['file_name'])
+
+    def calculate_similarity(self, tile_size=None):
+        """
+        Calculates the symmetric similarity matrix between all the HMMs in self.hmms. The column score
+        between column i of one profile (q) and column j of another (t) is the HHalign-style score
+        log2(sum_a q_i(a) t_j(a) / f(a)), where f is the master's null distribution. The similarity
+        of two profiles is the best ungapped local alignment score, i.e. the best sum of column scores
+        over a run of any diagonal of this score matrix, in bits.
+
+        All the profiles are padded into one (20, number of profiles * longest length) array so that
+        each block of query columns is scored against every profile in a single matrix product. The
+        block is then skewed so that each diagonal is one column, and the best run on each diagonal is
+        found from cumulative sums carried over between blocks.
+
+        Parameters
+        ----------
+        tile_size: int
+            the number of query columns scored per matrix product, to bound memory use for long or
+            many profiles. If None, all the columns of each profile are scored at once
+        """
+        nulls = np.array(self.hmms[0].nulls)
+        profiles = [hmm.get_probs().astype(np.float64) for hmm in self.hmms]
+        num_profiles = len(profiles)
+        max_length = max([len(profile) for profile in profiles])
+
+        targets = np.zeros((num_profiles, max_length, len(nulls)))
+        padding = np.ones((num_profiles, max_length), dtype=bool)
+        for profile_idx in range(num_profiles):
+            targets[profile_idx, :len(profiles[profile_idx])] = profiles[profile_idx]
+            padding[profile_idx, :len(profiles[profile_idx])] = False
+        targets = targets.reshape(-1, len(nulls)).T
+        padding = padding.reshape(-1)
+
+        # The scores are symmetric, so each profile is only scored against itself and later profiles
+        best_scores = np.zeros((num_profiles, num_profiles))
+        for profile_idx in range(num_profiles):
+            queries = profiles[profile_idx] / nulls
+            num_targets = num_profiles - profile_idx
+            later_targets = targets[:, profile_idx * max_length:]
+            later_padding = padding[profile_idx * max_length:]
+            query_length = len(queries)
+            step = tile_size if tile_size else query_length
+            # Running sum and its minimum so far along each diagonal j - i, indexed from -(query_length - 1)
+            diagonal_sums = np.zeros((num_targets, query_length + max_length - 1))
+            diagonal_mins = np.zeros((num_targets, query_length + max_length - 1))
+            for tile_start in range(0, query_length, step):
+                # Floor the scores of columns with no shared residues, and let padding score nothing
+                scores = np.log2(np.maximum(queries[tile_start:tile_start + step] @ later_targets, 2 ** -10))
+                scores[:, later_padding] = 0
+                rows = len(scores)
+                # Shift query row r right by (rows - 1 - r) so that each diagonal becomes one column
+                scores = scores.reshape(rows, num_targets, max_length).transpose(1, 0, 2)[:, ::-1]
+                skewed = np.zeros((num_targets, rows, max_length + rows))
+                skewed[:, :, :max_length] = scores
+                skewed = skewed.reshape(num_targets, -1)[:, :rows * (max_length + rows - 1)]
+                skewed = skewed.reshape(num_targets, rows, max_length + rows - 1)[:, ::-1]
+                # The best run ending at each row is the running sum less its lowest earlier value
+                diagonals = slice(query_length - rows - tile_start, query_length - tile_start + max_length - 1)
+                sums = np.cumsum(skewed, axis=1) + diagonal_sums[:, np.newaxis, diagonals]
+                mins = np.minimum(np.minimum.accumulate(sums, axis=1), diagonal_mins[:, np.newaxis, diagonals])
+                best_scores[profile_idx, profile_idx:] = np.maximum(best_scores[profile_idx, profile_idx:],
+                                                                    np.max(sums - mins, axis=(1, 2)))
+                diagonal_sums[:, diagonals] = sums[:, -1]
+                diagonal_mins[:, diagonals] = mins[:, -1]
+
+        self.matrix = np.maximum(best_scores, best_scores.T)
+
+    def draw_heatmap(self, file_name):
+        # Size the page to fit the matrix and the labels
+        cell_size = 20
+        padding = 200
+        num_hmms = len(self.hmms)
+        surface = cairo.PDFSurface(file_name, padding + num_hmms * cell_size + 150, padding + num_hmms * cell_size + 50)
+        self.cr = cairo.Context(surface)
+        self.cr.select_font_face("Arial", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+        self.cr.set_font_size(12)
+
+        # Scale from white (lowest similarity) to blue (highest) over the pairs of different HMMs, as
+        # the self-similarity on the diagonal is much higher
+        off_diagonal = self.matrix[~np.eye(num_hmms, dtype=bool)]
+        if len(off_diagonal) == 0:
+            off_diagonal = np.diag(self.matrix)
+        min_score = np.min(off_diagonal)
+        max_score = np.max(off_diagonal)
+        score_range = max(max_score - min_score, 1e-9)
+        for row in range(num_hmms):
+            for column in range(num_hmms):
+                fraction = min((self.matrix[row, column] - min_score) / score_range, 1)
+                self.cr.set_source_rgb(1 - 0.9 * fraction, 1 - 0.7 * fraction, 1)
+                self.cr.rectangle(padding + column * cell_size, padding + row * cell_size, cell_size, cell_size)
+                self.cr.fill()
+
+        # Outline the matrix
+        self.cr.set_source_rgb(0, 0, 0)
+        self.cr.set_line_width(1)
+        self.cr.rectangle(padding, padding, num_hmms * cell_size, num_hmms * cell_size)
+        self.cr.stroke()
+
+        # Label the rows on the left and the columns above
+        for hmm_idx in range(num_hmms):
+            name = self.hmms[hmm_idx].name
+            (x, y, width, height, dx, dy) = self.cr.text_extents(name)
+            self.cr.move_to(padding - width - 5, padding + (hmm_idx + 0.5) * cell_size + height / 2)
+            self.cr.show_text(name)
+            self.cr.move_to(padding + (hmm_idx + 0.5) * cell_size + height / 2, padding - 5)
+            self.cr.rotate(-math.pi / 2)
+            self.cr.show_text(name)
+            self.cr.rotate(math.pi / 2)
+
+        # Add a colour bar
+        bar_left = padding + num_hmms * cell_size + 30
+        bar_height = num_hmms * cell_size
+        for i in range(int(bar_height)):
+            fraction = 1 - i / bar_height
+            self.cr.set_source_rgb(1 - 0.9 * fraction, 1 - 0.7 * fraction, 1)
+            self.cr.rectangle(bar_left, padding + i, 15, 1)
+            self.cr.fill()
+        self.cr.set_source_rgb(0, 0, 0)
+        self.cr.rectangle(bar_left, padding, 15, bar_height)
+        self.cr.stroke()
+        for label, y in [("%.1f bits" % max_score, padding), ("%.1f bits" % min_score, padding + bar_height)]:
+            (x, y_bearing, width, height, dx, dy) = self.cr.text_extents(label)
+            self.cr.move_to(bar_left + 20, y + height / 2)
+            self.cr.show_text(label)
+
+        # Save the file
+        self.cr.show_page()
+        surface.finish()
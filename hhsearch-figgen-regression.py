@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+import copy
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import cairo
+import numpy as np
+import HitTable
+from OutputFigure import OutputFigure
+from MultiOutputFigure import MultiOutputFigure
+from argparse import ArgumentParser
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+class SkylignStandIn(BaseHTTPRequestHandler):
+    """
+    SkylignStandIn is a local replacement for the Skylign web service, so that figures using the
+    "skylign" conservation plot can be rendered offline. It accepts the same upload as skylign.org
+    and returns letter heights for each match column: the information content of the column shared
+    between the residues that are above background frequency. For an a3m alignment, the residue
+    frequencies are counted against a uniform background; for an HHM file (uploaded in place of
+    the a3m for hits that have none, see prepare_hmms), the match state probabilities are used
+    against the HMM's null probabilities. The heights will not match Skylign exactly, but are
+    deterministic.
+    """
+
+    models = {}
+
+    def do_POST(self):
+        # Pull the uploaded alignment out of the multipart form
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = BytesParser(policy=policy.default).parsebytes(
+            b"Content-Type: " + self.headers['Content-Type'].encode() + b"\r\n\r\n" + body)
+        a3m = ''
+        for part in message.iter_parts():
+            if part.get_param('name', header='content-disposition') == 'file':
+                a3m = part.get_payload(decode=True).decode()
+
+        model_id = str(len(SkylignStandIn.models))
+        SkylignStandIn.models[model_id] = self.get_height_arr(a3m)
+        self.send_json({'url': 'http://%s:%d/models/%s' % (self.server.server_address[0],
+                                                            self.server.server_address[1], model_id)})
+
+    def do_GET(self):
+        self.send_json({'height_arr': SkylignStandIn.models[self.path.split('/')[-1]]})
+
+    def send_json(self, data):
+        response = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        return
+
+    @staticmethod
+    def get_height_arr(upload):
+        if upload.startswith("HHsearch"):
+            probs, background = SkylignStandIn.get_hmm_probs(upload)
+        else:
+            probs = SkylignStandIn.get_a3m_probs(upload)
+            background = np.full(len(AMINO_ACIDS), 1 / len(AMINO_ACIDS))
+        height_arr = []
+        for column in probs:
+            information = np.sum(column[column > 0] * np.log2(column[column > 0] / background[column > 0]))
+            above = np.where(column > background, column, 0)
+            heights = information * above / max(np.sum(above), 1e-9)
+            height_arr.append([aa + ":" + str(height) for aa, height in zip(AMINO_ACIDS, heights)])
+        return height_arr
+
+    @staticmethod
+    def get_a3m_probs(a3m):
+        # Match columns are the upper case residues and gaps; lower case residues and dots are insertions
+        sequences = []
+        for record in a3m.split('>')[1:]:
+            sequence = ''.join(record.split('\n')[1:])
+            sequences.append([residue for residue in sequence if residue.isupper() or residue == '-'])
+        probs = []
+        for column in zip(*sequences):
+            counts = np.array([column.count(aa) for aa in AMINO_ACIDS], dtype=np.float64)
+            probs.append(counts / max(np.sum(counts), 1))
+        return np.array(probs).reshape(-1, len(AMINO_ACIDS))
+
+    @staticmethod
+    def get_hmm_probs(hhm):
+        # Scores are -1000 * log2 p, with * for a probability of 0. The match state lines follow the HMM
+        # header, the transition header and the initial transitions, with three lines per column
+        lines = hhm.split('\n')
+        def decode(scores):
+            return np.array([0 if score == '*' else 2 ** (int(score) / -1000) for score in scores])
+        background = decode([line for line in lines if line.startswith("NULL")][0].split()[1:21])
+        first_line = [idx for idx, line in enumerate(lines) if line.startswith("HMM ")][0] + 3
+        length = int([line for line in lines if line.startswith("LENG")][0].split()[1])
+        probs = [decode(lines[first_line + 3 * column].split()[2:22]) for column in range(length)]
+        return np.array(probs).reshape(-1, len(AMINO_ACIDS)), background
+
+
+def get_cases(base_config, multi_config, skylign_url, output_dir):
+    """
+    Returns the regression cases as a dict of case name to figure configuration. These are the
+    test-data/kkt17.json scenario itself, one generated configuration for each subplot_type in both
+    the normal and split views, generated configurations for the coverage_track, ss_window and
+    compact options, and the test-data/kkt17_multi.json scenario in both panel layouts. File names
+    in the configurations are made absolute, as the cases are rendered from the input directory
+    set up by prepare_hmms.
+
+    Parameters
+    ----------
+    base_config: dict
+        the configuration loaded from test-data/kkt17.json
+    multi_config: dict
+        the configuration loaded from test-data/kkt17_multi.json
+    skylign_url: str
+        the URL of the local Skylign stand-in
+    output_dir: str
+        the directory to render the PNGs into
+    """
+    cases = {'kkt17': copy.deepcopy(base_config)}
+    for subplot_type in ['logo', 'secondary', 'psiplot']:
+        for split in [False, True]:
+            config = copy.deepcopy(base_config)
+            config['output']['subplot_type'] = subplot_type
+            config['output']['split'] = split
+            config['output']['conservation_plot'] = {'type': 'traditional'}
+            # Split figures draw hits above the master, so need moving down the page
+            config['page']['padding_top'] = 700 if split else 200
+            config['page']['height'] = 1500 if split else 1200
+            cases[subplot_type + ('_split' if split else '_normal')] = config
+
+    # The optional output settings, each on top of one of the cases above
+    cases['coverage_normal'] = copy.deepcopy(cases['psiplot_normal'])
+    cases['coverage_normal']['output']['coverage_track'] = {'height': 60}
+    cases['coverage_split'] = copy.deepcopy(cases['logo_split'])
+    cases['coverage_split']['output']['coverage_track'] = {'height': 60,
+                                                           'e_value_bins': [0.00001, 0.001, 0.05, 1, 10]}
+    cases['coverage_split']['page']['padding_top'] = 800
+    cases['coverage_split']['page']['height'] = 1600
+    cases['secondary_binned'] = copy.deepcopy(cases['secondary_normal'])
+    cases['secondary_binned']['output']['ss_window'] = {'mode': 'binned', 'size': 5}
+    cases['secondary_moving'] = copy.deepcopy(cases['secondary_normal'])
+    cases['secondary_moving']['output']['ss_window'] = {'mode': 'moving', 'size': 9}
+    cases['psiplot_binned'] = copy.deepcopy(cases['psiplot_normal'])
+    cases['psiplot_binned']['output']['ss_window'] = {'mode': 'binned', 'size': 5}
+    cases['psiplot_moving'] = copy.deepcopy(cases['psiplot_normal'])
+    cases['psiplot_moving']['output']['ss_window'] = {'mode': 'moving', 'size': 9}
+    cases['logo_compact'] = copy.deepcopy(cases['logo_normal'])
+    cases['logo_compact']['output']['compact'] = True
+
+    # Several masters, stacked on one page, or on one page each (which can only be saved as a PDF)
+    cases['multi_stacked'] = copy.deepcopy(multi_config)
+    cases['multi_pages'] = copy.deepcopy(multi_config)
+    cases['multi_pages']['output']['panel_layout'] = 'pages'
+
+    for name, config in cases.items():
+        extension = '.pdf' if config['output'].get('panel_layout') == 'pages' else '.png'
+        config['output']['file_name'] = os.path.join(output_dir, name + extension)
+        config['output']['conservation_plot']['url'] = skylign_url
+        for panel in config.get('masters', [config]):
+            for section, key in [('master', 'hmm_file'), ('master', 'alignment_a3m'), ('searches', 'pfam'),
+                                 ('searches', 'hits')]:
+                if key in panel[section]:
+                    panel[section][key] = os.path.abspath(panel[section][key])
+    return cases
+
+
+def prepare_hmms(input_dir):
+    """
+    Copies the hit HMMs from hmms into input_dir/hmms, for the cases to be rendered from input_dir.
+    Skylign plots need an a3m alignment for every hit, which the repository only has for some (or
+    none) of the hits, so for each hit without one, a copy of the hit's HMM is saved in place of the
+    a3m. The Skylign stand-in recognises these and takes the letter heights from the HMM's match
+    state probabilities instead.
+
+    Parameters
+    ----------
+    input_dir: str
+        the directory to set up
+    """
+    os.makedirs(os.path.join(input_dir, 'hmms'), exist_ok=True)
+    for file_name in os.listdir('hmms'):
+        shutil.copyfile(os.path.join('hmms', file_name), os.path.join(input_dir, 'hmms', file_name))
+        if file_name.endswith('.fa.hmm.ss.hmm'):
+            a3m_file_name = file_name[:-len('.hmm')] + '.a3m'
+            if not os.path.isfile(os.path.join('hmms', a3m_file_name)):
+                shutil.copyfile(os.path.join('hmms', file_name), os.path.join(input_dir, 'hmms', a3m_file_name))
+
+
+def get_missing_inputs(config):
+    """
+    Returns the input files needed to render a case that do not exist. As in add_hits, the hits
+    drawn are hit numbers 2 to config.output.max_hits of the results file, so their HMMs are listed,
+    along with their a3m alignments for Skylign plots.
+
+    Parameters
+    ----------
+    config: dict
+        the figure configuration
+    """
+    needed = []
+    for panel in config.get('masters', [config]):
+        needed += [panel['master']['hmm_file'], panel['searches']['pfam'], panel['searches']['hits']]
+        if config['output']['conservation_plot']['type'] == 'skylign':
+            needed.append(panel['master']['alignment_a3m'])
+        hit_table = HitTable.HitTable(panel['searches']['hits'])
+        drawn = np.isin(hit_table.numbers, np.arange(2, config['output']['max_hits'] + 1))
+        for hit_idx in np.nonzero(drawn)[0]:
+            needed.append("hmms/" + hit_table.names[hit_idx] + ".fa.hmm.ss.hmm")
+            if config['output']['conservation_plot']['type'] == 'skylign':
+                needed.append("hmms/" + hit_table.names[hit_idx] + ".fa.hmm.ss.a3m")
+    return [file_name for file_name in dict.fromkeys(needed) if not os.path.isfile(file_name)]
+
+
+def read_png(file_name):
+    # Returns the image as a (height, width, 4) array of bytes
+    surface = cairo.ImageSurface.create_from_png(file_name)
+    data = np.ndarray(shape=(surface.get_height(), surface.get_stride() // 4, 4), dtype=np.uint8,
+                      buffer=surface.get_data())
+    return data[:, :surface.get_width()].copy()
+
+
+def compare_png(file_name, golden_file_name, pixel_tolerance, diff_file_name):
+    """
+    Returns the fraction of pixels that differ between a PNG and its golden image by more than
+    pixel_tolerance in any channel (1 if the sizes differ), and saves an image of the differing pixels
+    to diff_file_name.
+
+    Parameters
+    ----------
+    file_name: str
+        the newly rendered PNG
+    golden_file_name: str
+        the stored golden PNG
+    pixel_tolerance: int
+        the largest per-channel difference (0-255) that is not counted as a change
+    diff_file_name: str
+        where to save the image of differing pixels, drawn in red over a faded copy of the golden image
+    """
+    image = read_png(file_name)
+    golden = read_png(golden_file_name)
+    if image.shape != golden.shape:
+        return 1
+    changed = np.max(np.abs(image.astype(np.int16) - golden.astype(np.int16)), axis=2) > pixel_tolerance
+    if np.any(changed):
+        # Cairo stores pixels as BGRA
+        diff = (golden // 4 + 191).astype(np.uint8)
+        diff[changed] = [0, 0, 255, 255]
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, diff.shape[1], diff.shape[0])
+        surface_data = np.ndarray(shape=(surface.get_height(), surface.get_stride() // 4, 4), dtype=np.uint8,
+                                  buffer=surface.get_data())
+        surface_data[:, :diff.shape[1]] = diff
+        surface.mark_dirty()
+        surface.write_to_png(diff_file_name)
+    return float(np.mean(changed))
+
+
+if __name__ == "__main__":
+    """
+    Golden-output regression harness for the renderer. This renders the test-data/kkt17.json
+    scenario, generated configurations covering every subplot_type in the normal and split views
+    and the optional output settings, and the test-data/kkt17_multi.json scenario, to PNG. Each PNG
+    is compared to a stored golden image with a tolerance-based pixel diff, and the render time and
+    file size of each case are reported. Skylign is replaced by a local stand-in, so the harness
+    runs offline.
+    """
+
+    parser = ArgumentParser(description="Render the regression cases and compare them to the golden images")
+    parser.add_argument('--golden-dir', default='test-data/golden', help="Directory holding the golden PNGs")
+    parser.add_argument('--output-dir', default='regression-output', help="Directory to render the PNGs into")
+    parser.add_argument('--update', action='store_true', help="Replace the golden PNGs with the new renders")
+    parser.add_argument('--case', action='append',
+                        help="Only render this case (can be given more than once). By default all cases are rendered")
+    parser.add_argument('--pixel-tolerance', type=int, default=16,
+                        help="Largest per-channel difference (0-255) not counted as a changed pixel")
+    parser.add_argument('--max-changed', type=float, default=0.001,
+                        help="Largest fraction of changed pixels for a case to pass")
+    parser.add_argument('--report', help="Path to save the results as JSON")
+    arguments = parser.parse_args()
+
+    # Start the Skylign stand-in on a free local port
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SkylignStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    skylign_url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    with open('test-data/kkt17.json') as json_file:
+        base_config = json.load(json_file)
+    with open('test-data/kkt17_multi.json') as json_file:
+        multi_config = json.load(json_file)
+    golden_dir = os.path.abspath(arguments.golden_dir)
+    output_dir = os.path.abspath(arguments.output_dir)
+    report_file_name = os.path.abspath(arguments.report) if arguments.report else None
+    os.makedirs(output_dir, exist_ok=True)
+    if arguments.update:
+        os.makedirs(golden_dir, exist_ok=True)
+    cases = get_cases(base_config, multi_config, skylign_url, output_dir)
+    if arguments.case:
+        cases = {name: cases[name] for name in arguments.case}
+
+    # Render from a copy of the hit HMMs, with stand-ins for the missing a3m files
+    input_dir = os.path.join(output_dir, 'inputs')
+    prepare_hmms(input_dir)
+    os.chdir(input_dir)
+
+    results = {}
+    for name, config in cases.items():
+        result = {'status': 'pass'}
+        missing_inputs = get_missing_inputs(config)
+        if missing_inputs:
+            result['status'] = 'error'
+            result['message'] = "missing " + ", ".join(missing_inputs)
+            results[name] = result
+            continue
+
+        # Render the case, timing it
+        start_time = time.perf_counter()
+        try:
+            if 'masters' in config:
+                MultiOutputFigure(config, True)
+            else:
+                OutputFigure(config, True)
+        except (Exception, SystemExit) as error:
+            result['status'] = 'error'
+            result['message'] = repr(error)
+            results[name] = result
+            continue
+        result['render_time'] = time.perf_counter() - start_time
+        result['file_size'] = os.path.getsize(config['output']['file_name'])
+
+        # Compare against the golden image
+        golden_file_name = os.path.join(golden_dir, name + '.png')
+        diff_file_name = os.path.join(output_dir, name + '-diff.png')
+        if not config['output']['file_name'].endswith('.png'):
+            result['message'] = "PDF - rendered, but not compared"
+        elif arguments.update:
+            shutil.copyfile(config['output']['file_name'], golden_file_name)
+            result['status'] = 'updated'
+        elif not os.path.isfile(golden_file_name):
+            result['status'] = 'fail'
+            result['message'] = "no golden image - run with --update to create it"
+        else:
+            if os.path.isfile(diff_file_name):
+                os.remove(diff_file_name)
+            result['golden_file_size'] = os.path.getsize(golden_file_name)
+            result['changed_fraction'] = compare_png(config['output']['file_name'], golden_file_name,
+                                                     arguments.pixel_tolerance, diff_file_name)
+            if result['changed_fraction'] > arguments.max_changed:
+                result['status'] = 'fail'
+                result['message'] = "see " + diff_file_name
+        results[name] = result
+
+    server.shutdown()
+
+    # Report the results
+    print("%-18s %-8s %10s %12s %10s" % ("case", "status", "time (s)", "size (B)", "changed"))
+    for name, result in results.items():
+        render_time = "%.2f" % result['render_time'] if 'render_time' in result else "-"
+        file_size = str(result['file_size']) if 'file_size' in result else "-"
+        changed = "%.5f" % result['changed_fraction'] if 'changed_fraction' in result else "-"
+        print("%-18s %-8s %10s %12s %10s %s" % (name, result['status'], render_time, file_size, changed,
+                                                result.get('message', '')))
+    if report_file_name:
+        with open(report_file_name, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+
+    if any([result['status'] in ['fail', 'error'] for result in results.values()]):
+        sys.exit(1)
@@ -2,7 +2,7 @@
 import sys
 import json
 import ParsedHMM
-from OutputFigure import OutputFigure
+from FigureModel import FigureModel
 from argparse import ArgumentParser
 
 if __name__ == "__main__":
@@ -22,6 +22,27 @@ if __name__ == "__main__":
     with open(arguments.config) as json_file:
         config = json.load(json_file)
 
-    # Generate the output figure
-    output_figure = OutputFigure(config, True)
-
+    # Generate the output figure, with one panel per master if several are given
+    # The figure modules need PyCairo, so are only imported when drawing, leaving data_only exports without it
+    if 'masters' in config:
+        # Export and the similarity heatmap work on a single master
+        for option in ['export', 'similarity_heatmap']:
+            if option in config['output']:
+                print("The " + option + " output option is not available for configurations with several masters.")
+                exit(1)
+        from MultiOutputFigure import MultiOutputFigure
+        output_figure = MultiOutputFigure(config, True)
+    else:
+        export_config = config['output'].get('export', {})
+        parsed_hmm_master = None
+        if not export_config.get('data_only', False):
+            from OutputFigure import OutputFigure
+            output_figure = OutputFigure(config, True)
+            parsed_hmm_master = output_figure.parsed_hmm_master
+            if 'similarity_heatmap' in config['output']:
+                # Reuse the master and hit HMMs already parsed for the main figure
+                from SimilarityFigure import SimilarityFigure
+                similarity_figure = SimilarityFigure(config, output_figure.parsed_hmm_master, output_figure.hmm_cache)
+        if 'file_name' in export_config:
+            # Export the numbers behind the figure
+            FigureModel(config, parsed_hmm_master).save(export_config['file_name'])